@@ -1,45 +1,217 @@
-from dotenv import load_dotenv
-import json, logging, os, requests
+import asyncio
+import contextlib
+import httpx
+import orjson
+import logging, time
 from datetime import datetime
+from typing import Final
 from zoneinfo import ZoneInfo
 
 from livekit import agents, rtc, api
 from livekit.agents import AgentServer, AgentSession, Agent, room_io, RunContext, get_job_context, AutoSubscribe
 from livekit.agents.llm import function_tool
 from livekit.plugins import (
-    openai, 
-    noise_cancellation, 
-    bey
+    openai,
+    noise_cancellation,
 )
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
-load_dotenv(".env.local")
+from config import CACHE_TTL, N8N_MEMORY_WEBHOOK_URL, N8N_TRANSCRIPT_WEBHOOK_URL
 
-def send_transcript_to_n8n(transcript_data: str, timestamp: str):
-    """Send transcript to n8n webhook."""
+_LA_TZ = ZoneInfo("America/Los_Angeles")
 
-    payload = {
-        "transcript": transcript_data,
-        "timestamp": timestamp
-    }
+_SIP_KIND = rtc.ParticipantKind.PARTICIPANT_KIND_SIP
 
-    response = requests.post(os.getenv("N8N_TRANSCRIPT_WEBHOOK_URL"), json=payload)
-    logging.info(f"Transcript sent, status: {response.status_code}")
+def _is_phone(room: rtc.Room) -> bool:
+    """Detect an inbound SIP call via the dispatch-rule room prefix, falling back to a participant scan."""
+    return room.name.startswith("call-") or any(
+        p.kind == _SIP_KIND for p in room.remote_participants.values()
+    )
+
+# One RealtimeModel shared by every session: the wrapper is a per-session
+# connection factory, so there is no need to redo its URL/credential setup
+# on each inbound call.
+_REALTIME_LLM = openai.realtime.RealtimeModel(
+    model="gpt-4o-mini-realtime-preview-2024-12-17",
+    voice="coral",
+)
+
+# Shared noise-cancellation instances; constructing these per participant join
+# reallocates DSP state and delays the first audio frame.
+_NC_TELEPHONY = noise_cancellation.BVCTelephony()
+_NC_DEFAULT = noise_cancellation.BVC()
+
+# Keep webhook round-trips strictly bounded so a stalled n8n endpoint can't
+# wedge a tool call, and retry transient network failures with backoff. The
+# transcript default stays tight (the caller is already gone); the memory
+# fetch gets a little more room since the sheet lookup is slower server-side.
+_WEBHOOK_TIMEOUT = httpx.Timeout(3.0, connect=1.0)
+_MEMORY_TIMEOUT = httpx.Timeout(5.0, connect=2.0)
+
+# One shared client so every webhook call reuses pooled TCP/TLS connections
+# instead of blocking the event loop on a fresh handshake. Both webhook URLs
+# live on one host, so HTTP/2 lets concurrent calls multiplex one connection.
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=_WEBHOOK_TIMEOUT,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+)
+
+async def _webhook_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Issue an HTTP request to n8n with timeout and retry-with-backoff."""
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential_jitter(initial=0.1, max=1.0),
+        retry=retry_if_exception_type((httpx.TimeoutException, httpx.TransportError)),
+        reraise=True,
+    ):
+        with attempt:
+            return await _http.request(method, url, **kwargs)
+
+# Warm the connection pool so the first real webhook call - often mid-
+# conversation - doesn't pay the TCP+TLS handshake to n8n.
+_prewarmed = False
+
+async def _prewarm_http():
+    with contextlib.suppress(Exception):
+        await _http.head(N8N_MEMORY_WEBHOOK_URL, timeout=httpx.Timeout(2.0))
+
+def _prewarm_once():
+    global _prewarmed
+    if not _prewarmed:
+        _prewarmed = True
+        _fire_and_forget(_prewarm_http())
+
+# In-flight background tasks, referenced so the event loop doesn't GC them mid-send.
+_pending_tasks: set[asyncio.Task] = set()
+
+def _fire_and_forget(coro) -> asyncio.Task:
+    """Run a coroutine in the background without awaiting its result."""
+    task = asyncio.create_task(coro)
+    _pending_tasks.add(task)
+    task.add_done_callback(_pending_tasks.discard)
+    return task
+
+# Transcripts are queued and drained by a single worker so shipping stays off
+# the caller path and bursts of hangups serialize over the pooled connection.
+# Each entry goes out as its own POST: the n8n webhook workflow reads a
+# single-object body ({{ $json.body.transcript }}), not an array of items.
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_transcript_queue: asyncio.Queue | None = None
+# The worker loops forever, so it lives outside _pending_tasks; draining at
+# shutdown must not wait on it.
+_transcript_worker_task: asyncio.Task | None = None
+
+def _ensure_transcript_worker() -> asyncio.Queue:
+    global _transcript_queue, _transcript_worker_task
+    if _transcript_queue is None:
+        _transcript_queue = asyncio.Queue()
+        _transcript_worker_task = asyncio.create_task(_transcript_worker())
+    return _transcript_queue
+
+async def _transcript_worker():
+    while True:
+        body = await _transcript_queue.get()
+        try:
+            response = await _webhook_request(
+                "POST", N8N_TRANSCRIPT_WEBHOOK_URL,
+                content=body, headers=_JSON_HEADERS,
+            )
+            logging.info("Transcript sent, status: %s", response.status_code)
+        except Exception as e:
+            # Retries with backoff are exhausted at this point; drop the
+            # transcript rather than wedge the worker, but leave enough
+            # context to spot the loss.
+            logging.error("Dropping transcript (%d bytes) after retries: %s", len(body), e)
+        finally:
+            _transcript_queue.task_done()
+
+async def _drain_transcripts():
+    """Flush queued transcripts and in-flight sends before the job exits."""
+    shipping = [t for t in _pending_tasks if not t.done()]
+    if shipping:
+        await asyncio.gather(*shipping, return_exceptions=True)
+    if _transcript_queue is not None:
+        await _transcript_queue.join()
+
+async def send_transcript_to_n8n(payload: bytes):
+    """Queue a pre-serialized transcript payload for batched delivery to n8n."""
+    await _ensure_transcript_worker().put(payload)
+
+# Short-TTL cache for the memory endpoint: the LLM tends to re-ask within a
+# session, and concurrent sessions would otherwise all hit n8n for the same
+# sheet. The lock coalesces simultaneous misses into one fetch.
+_DEBRIEF_TTL = CACHE_TTL
+_debrief_cache: tuple[float, str] | None = None
+_debrief_etag: str | None = None
+_debrief_lock = asyncio.Lock()
+
+async def _refresh_debrief() -> str:
+    """Fetch the memory endpoint into the TTL cache, coalescing concurrent refreshes."""
+    global _debrief_cache, _debrief_etag
+
+    if _debrief_cache and time.monotonic() - _debrief_cache[0] < _DEBRIEF_TTL:
+        return _debrief_cache[1]
+
+    async with _debrief_lock:
+        # Another coroutine may have refreshed the cache while we waited.
+        if _debrief_cache and time.monotonic() - _debrief_cache[0] < _DEBRIEF_TTL:
+            return _debrief_cache[1]
+
+        try:
+            # Conditional GET: when the sheet hasn't changed, n8n answers 304
+            # and we skip the body transfer entirely. Single attempt, no retry
+            # helper: the model is waiting on this, and the stale fallback
+            # below is a better answer than seconds of backoff.
+            headers = {"If-None-Match": _debrief_etag} if _debrief_etag else None
+            response = await _http.get(N8N_MEMORY_WEBHOOK_URL, headers=headers, timeout=_MEMORY_TIMEOUT)
+        except Exception:
+            # Serve the last good body stale rather than an error string; the
+            # next TTL expiry will try n8n again.
+            return _debrief_cache[1] if _debrief_cache else "No data available"
+
+        if response.status_code == 304 and _debrief_cache:
+            body = _debrief_cache[1]
+        elif response.status_code == 200:
+            body = response.text
+            _debrief_etag = response.headers.get("ETag")
+        elif _debrief_cache:
+            return _debrief_cache[1]
+        else:
+            body = ""
+
+        _debrief_cache = (time.monotonic(), body)
+        return body
 
 @function_tool()
 async def get_call_debrief(run_ctx: RunContext) -> str:
     """Retrieve call history and voicemail summaries from Google Sheets. Returns empty string if no calls exist."""
     run_ctx.disallow_interruptions()
-    
-    try:
-        response = requests.get(os.getenv("N8N_MEMORY_WEBHOOK_URL"))
-        return response.text if response.status_code == 200 else ""
-    except Exception:
-        return "No data available"
+    return await _refresh_debrief()
+
+def _serialize_payload(history, timestamp: str) -> bytes:
+    # The SDK only exposes the items through to_dict(); do the whole traversal
+    # and encode in one go so none of it runs on the event loop. The transcript
+    # stays a JSON string to keep the n8n payload shape unchanged.
+    transcript_data = orjson.dumps(history.to_dict()["items"]).decode()
+    return orjson.dumps({"transcript": transcript_data, "timestamp": timestamp})
+
+async def _ship_session_transcript(session: AgentSession):
+    """Serialize the session history off the event loop and queue it for n8n."""
+    # hangup_call and the participant_disconnected handler can both fire for
+    # one call; whichever gets here first ships, the other becomes a no-op.
+    if getattr(session, "_transcript_shipped", False):
+        return
+    session._transcript_shipped = True
+
+    timestamp = datetime.now(_LA_TZ).isoformat()
+    payload = await asyncio.get_running_loop().run_in_executor(None, _serialize_payload, session.history, timestamp)
+    await send_transcript_to_n8n(payload)
 
 @function_tool()
 async def hangup_call(run_ctx: RunContext, is_spam: bool = False):
     """Hang up the call. Use is_spam=True if the caller mentions: car warranty, extended warranty, insurance offers, debt relief, credit card offers, timeshare, or any unsolicited sales pitch. Use is_spam=False for normal call endings after collecting the caller's information."""
-    logging.info(f"hangup_call executed, spam: {is_spam}")
+    logging.info("hangup_call executed, spam: %s", is_spam)
     run_ctx.disallow_interruptions()
     
     if is_spam:
@@ -50,57 +222,82 @@ async def hangup_call(run_ctx: RunContext, is_spam: bool = False):
     await run_ctx.session.generate_reply(instructions=message)
     await run_ctx.wait_for_playout()
     
-    transcript_data = json.dumps(run_ctx.session.history.to_dict()["items"])
-    timestamp = datetime.now(ZoneInfo("America/Los_Angeles")).isoformat()
-    
+    # Start shipping before the room delete so the two I/O latencies overlap
+    # instead of serializing; the history is complete once playout finished.
+    _fire_and_forget(_ship_session_transcript(run_ctx.session))
+
     ctx = get_job_context()
     try:
-        logging.info(f"Deleting room: {ctx.room.name}")
+        logging.info("Deleting room: %s", ctx.room.name)
         await ctx.api.room.delete_room(api.DeleteRoomRequest(room=ctx.room.name))
     except Exception as e:
-        logging.error(f"Delete room failed: {e}")
-    
-    send_transcript_to_n8n(transcript_data, timestamp)
+        logging.error("Delete room failed: %s", e)
+
+# Tool lists are fixed per mode; building them once keeps Assistant.__init__
+# to a pointer swap per session.
+_PHONE_TOOLS = [hangup_call]
+_WEB_TOOLS = [get_call_debrief]
+
+# Persona prompts are constant per mode; build them once at import instead of
+# re-materializing the strings on every inbound call.
+PHONE_INSTRUCTIONS: Final[str] = """
+You are "Sarah", a protective AI Receptionist for James, answering a phone call forwarded from voicemail.
+PRIORITY: If the caller mentions ANY of these: car warranty, selling a car warranty, extended warranty, insurance offers, debt relief, credit card offers, timeshare, or ANY unsolicited sales pitch, you MUST IMMEDIATELY call the hangup_call function tool with is_spam=True. Do not respond verbally first. Do not ask questions. Just call the tool immediately.
+For legitimate calls: Screen the call, collect name and full message. Let them finish speaking before ending.
+IMPORTANT: When the caller says goodbye, thanks you, says they're done, or indicates the conversation is complete, you MUST IMMEDIATELY call hangup_call with is_spam=False. Do NOT say goodbye or thank you verbally - the tool will handle the goodbye message. Just call the tool immediately when they're done.
+Keep responses under 2 sentences. Be professional, firm, and concise.
+"""
+
+WEB_INSTRUCTIONS: Final[str] = """
+You are "Sarah", James's Chief of Staff, appearing as a 3D Avatar on the web dashboard.
+When asked about voicemails, calls, or call history, use get_call_debrief to retrieve from Google Sheets. If data exists, summarize it. If empty, say "I don't see any recent calls yet." Never invent call information.
+Keep responses concise (1-2 sentences unless detail is requested). Welcome James back and offer help.
+"""
 
 class Assistant(Agent):
     def __init__(self, is_phone) -> None:
-        if is_phone:
-            instructions = """
-            You are "Sarah", a protective AI Receptionist for James, answering a phone call forwarded from voicemail.
-            PRIORITY: If the caller mentions ANY of these: car warranty, selling a car warranty, extended warranty, insurance offers, debt relief, credit card offers, timeshare, or ANY unsolicited sales pitch, you MUST IMMEDIATELY call the hangup_call function tool with is_spam=True. Do not respond verbally first. Do not ask questions. Just call the tool immediately.
-            For legitimate calls: Screen the call, collect name and full message. Let them finish speaking before ending. 
-            IMPORTANT: When the caller says goodbye, thanks you, says they're done, or indicates the conversation is complete, you MUST IMMEDIATELY call hangup_call with is_spam=False. Do NOT say goodbye or thank you verbally - the tool will handle the goodbye message. Just call the tool immediately when they're done.
-            Keep responses under 2 sentences. Be professional, firm, and concise.
-            """
-            tools = [hangup_call]
-        else:
-            instructions = """
-            You are "Sarah", James's Chief of Staff, appearing as a 3D Avatar on the web dashboard.
-            When asked about voicemails, calls, or call history, use get_call_debrief to retrieve from Google Sheets. If data exists, summarize it. If empty, say "I don't see any recent calls yet." Never invent call information.
-            Keep responses concise (1-2 sentences unless detail is requested). Welcome James back and offer help.
-            """
-            tools = [get_call_debrief]
-        
-        super().__init__(instructions=instructions, tools=tools)
+        super().__init__(
+            instructions=PHONE_INSTRUCTIONS if is_phone else WEB_INSTRUCTIONS,
+            tools=_PHONE_TOOLS if is_phone else _WEB_TOOLS,
+        )
 
 server = AgentServer()
 
 @server.rtc_session(agent_name="my-vision-agent")
 async def my_agent(ctx: agents.JobContext):
+    _prewarm_once()
 
     await ctx.connect(auto_subscribe=AutoSubscribe.AUDIO_ONLY)
-    is_phone = ctx.room.name.startswith("call-")
+    # Fire-and-forget shipping must still complete before the job process
+    # exits, or the transcript of the call that just ended is lost.
+    ctx.add_shutdown_callback(_drain_transcripts)
+    is_phone = _is_phone(ctx.room)
     
-    logging.info(f"is_phone={is_phone}, room={ctx.room.name}")
+    logging.info("is_phone=%s, room=%s", is_phone, ctx.room.name)
 
-    session = AgentSession(
-        llm=openai.realtime.RealtimeModel(
-            model="gpt-4o-mini-realtime-preview-2024-12-17",
-            voice="coral",
-        )
-    )
+    session = AgentSession(llm=_REALTIME_LLM)
+
+    if is_phone:
+        # Callers who hang up before the LLM reaches hangup_call would
+        # otherwise never get their transcript saved. The callback does no
+        # I/O itself: it hands the shipping coroutine to the session loop,
+        # which also keeps it safe if the SDK ever dispatches room events
+        # from its signaling thread.
+        loop = asyncio.get_running_loop()
+
+        def on_participant_disconnected(participant: rtc.RemoteParticipant):
+            if participant.kind == _SIP_KIND:
+                logging.info("SIP participant disconnected: %s", participant.identity)
+                loop.call_soon_threadsafe(_fire_and_forget, _ship_session_transcript(session))
+
+        ctx.room.on("participant_disconnected", on_participant_disconnected)
+    else:
+        # Warm the debrief cache while the session starts so the first
+        # voicemail question answers from memory instead of waiting on n8n.
+        _fire_and_forget(_refresh_debrief())
 
     # if not is_phone:
+    #     from livekit.plugins import bey  # lazy: the avatar SDK is heavy and phone calls never need it
     #     avatar = bey.AvatarSession(
     #         avatar_id="2bc759ab-a7e5-4b91-941d-9e42450d6546", 
     #     )
@@ -111,7 +308,7 @@ async def my_agent(ctx: agents.JobContext):
         agent=Assistant(is_phone=is_phone),
         room_options=room_io.RoomOptions(
             audio_input=room_io.AudioInputOptions(
-                noise_cancellation=lambda params: noise_cancellation.BVCTelephony() if params.participant.kind == rtc.ParticipantKind.PARTICIPANT_KIND_SIP else noise_cancellation.BVC(),
+                noise_cancellation=_NC_TELEPHONY if is_phone else _NC_DEFAULT,
             ),
         ),
     )
@@ -126,5 +323,14 @@ async def my_agent(ctx: agents.JobContext):
     )
     
 if __name__ == "__main__":
-    agents.cli.run_app(server)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass  # uvloop is unavailable on Windows; fall back to the default loop
+    try:
+        agents.cli.run_app(server)
+    finally:
+        with contextlib.suppress(Exception):
+            asyncio.run(_http.aclose())
 
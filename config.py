@@ -0,0 +1,20 @@
+"""Process-wide configuration: load .env.local once and resolve webhook URLs at startup."""
+
+import os
+from typing import Final
+
+from dotenv import load_dotenv
+
+load_dotenv(".env.local")
+
+def _require(name: str) -> str:
+    value = os.getenv(name)
+    if not value:
+        raise RuntimeError(f"Missing required environment variable: {name}")
+    return value
+
+N8N_TRANSCRIPT_WEBHOOK_URL: Final[str] = _require("N8N_TRANSCRIPT_WEBHOOK_URL")
+N8N_MEMORY_WEBHOOK_URL: Final[str] = _require("N8N_MEMORY_WEBHOOK_URL")
+
+# How long get_call_debrief serves a cached body before re-fetching from n8n.
+CACHE_TTL: Final[float] = float(os.getenv("CACHE_TTL", "30"))